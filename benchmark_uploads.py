@@ -0,0 +1,54 @@
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+# Measure upload throughput of a running API server.
+#
+# Run it once with METADATA_BATCH_ENABLED=false and once with it set to true
+# (restarting the server in between) to compare uploads per second:
+#
+#     python benchmark_uploads.py --uploads 500 --concurrency 32
+
+BASE_URL = "http://localhost:8001"
+
+# Minimal WAV file, same as in test_endpoints.py
+TEST_WAV_CONTENT = b'RIFF$\x00\x00\x00WAVEfmt \x10\x00\x00\x00\x01\x00\x01\x00D\xac\x00\x00\x88X\x01\x00\x02\x00\x10\x00data\x00\x00\x00\x00'
+
+
+def upload(session, index):
+    files = {
+        'file': (f'benchmark_{index}.wav', TEST_WAV_CONTENT, 'audio/wav')
+    }
+    response = session.post(f"{BASE_URL}/upload", files=files)
+    return response.json()["id"] if response.status_code == 200 else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure upload throughput of the API")
+    parser.add_argument("--uploads", type=int, default=200, help="number of files to upload")
+    parser.add_argument("--concurrency", type=int, default=16, help="uploads in flight at once")
+    parser.add_argument("--keep", action="store_true", help="do not delete the uploaded files afterwards")
+    args = parser.parse_args()
+
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=args.concurrency)
+    session.mount("http://", adapter)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        ids = list(executor.map(lambda index: upload(session, index), range(args.uploads)))
+    elapsed = time.perf_counter() - start
+
+    succeeded = [file_id for file_id in ids if file_id is not None]
+    print(f"Uploaded {len(succeeded)}/{args.uploads} files in {elapsed:.2f}s")
+    print(f"Throughput: {len(succeeded) / elapsed:.1f} uploads/s at concurrency {args.concurrency}")
+
+    if not args.keep:
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            list(executor.map(lambda file_id: session.delete(f"{BASE_URL}/files/{file_id}"), succeeded))
+
+
+if __name__ == "__main__":
+    main()
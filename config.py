@@ -22,3 +22,42 @@ except ImportError as e:
 
 # Storage bucket name for audio files
 AUDIO_BUCKET = "audio-files"
+
+# Object key layout for new uploads: "sharded" (<ab>/<cd>/<uuid>) or the
+# original "flat" (<uuid>_<filename>). Existing objects keep their key until
+# migrated with migrate_storage_layout.py.
+STORAGE_KEY_LAYOUTS = ("flat", "sharded")
+STORAGE_KEY_LAYOUT = os.getenv("STORAGE_KEY_LAYOUT", "sharded")
+
+if STORAGE_KEY_LAYOUT not in STORAGE_KEY_LAYOUTS:
+    raise ValueError(f"STORAGE_KEY_LAYOUT must be one of: {', '.join(STORAGE_KEY_LAYOUTS)}")
+
+# Write-behind batching for audio_files metadata inserts
+METADATA_BATCH_ENABLED = os.getenv("METADATA_BATCH_ENABLED", "false").lower() == "true"
+METADATA_BATCH_MAX_ROWS = int(os.getenv("METADATA_BATCH_MAX_ROWS", "50"))
+METADATA_BATCH_MAX_DELAY_MS = int(os.getenv("METADATA_BATCH_MAX_DELAY_MS", "20"))
+METADATA_BATCH_QUEUE_SIZE = int(os.getenv("METADATA_BATCH_QUEUE_SIZE", "1000"))
+
+# Rows requested per page by GET /files/export (PostgREST may return fewer,
+# up to the project's max rows setting; the export keeps paging either way)
+EXPORT_PAGE_SIZE = int(os.getenv("EXPORT_PAGE_SIZE", "1000"))
+
+# How long, and for how many keys, upload results are kept for replay to
+# clients that retry with the same Idempotency-Key header
+IDEMPOTENCY_TTL_SECONDS = int(os.getenv("IDEMPOTENCY_TTL_SECONDS", "86400"))
+IDEMPOTENCY_MAX_KEYS = int(os.getenv("IDEMPOTENCY_MAX_KEYS", "10000"))
+
+# Opt-in per-request profiling: requests carrying "X-Profile: <PROFILING_TOKEN>"
+# are profiled and their cProfile output saved to PROFILE_DIR
+PROFILING_ENABLED = os.getenv("PROFILING_ENABLED", "false").lower() == "true"
+PROFILING_TOKEN = os.getenv("PROFILING_TOKEN", "")
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+# Number of profiles kept in PROFILE_DIR; the oldest are deleted first
+PROFILE_MAX_FILES = int(os.getenv("PROFILE_MAX_FILES", "100"))
+
+# Background deletion: rows marked deleted are removed in batches of
+# DELETE_BATCH_SIZE, polling every DELETE_POLL_SECONDS and backing off up to
+# DELETE_MAX_BACKOFF_SECONDS while Supabase is failing
+DELETE_BATCH_SIZE = int(os.getenv("DELETE_BATCH_SIZE", "100"))
+DELETE_POLL_SECONDS = float(os.getenv("DELETE_POLL_SECONDS", "5"))
+DELETE_MAX_BACKOFF_SECONDS = float(os.getenv("DELETE_MAX_BACKOFF_SECONDS", "300"))
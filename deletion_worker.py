@@ -0,0 +1,87 @@
+import asyncio
+from datetime import datetime, timezone
+from typing import Optional
+from config import supabase
+from storage import delete_audio_files
+
+
+# Background worker that finishes deletes requested through the API.
+#
+# DELETE /files/{id} only sets deleted_at on the row, which hides it from
+# every read. Rows with deleted_at set therefore form a durable queue: the
+# worker takes the oldest batch of them, removes their objects with one
+# storage request and then deletes the rows. A failed batch stays in the
+# table and is retried with exponential backoff.
+class DeletionWorker:
+    def __init__(self, batch_size: int = 100, poll_seconds: float = 5, max_backoff_seconds: float = 300):
+        self.batch_size = batch_size
+        self.poll_seconds = poll_seconds
+        self.max_backoff = max_backoff_seconds
+        self.consecutive_failures = 0
+        self.last_error: Optional[str] = None
+        self.last_run: Optional[datetime] = None
+        self._wake: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+
+    async def start(self):
+        if self._task is not None:
+            return
+        self._stopping = False
+        self._wake = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    # Let the batch in progress finish, then stop
+    async def stop(self):
+        if self._task is None:
+            return
+        self._stopping = True
+        self._wake.set()
+        await self._task
+        self._task = None
+
+    # Start on the next batch now instead of at the next poll. Ignored while
+    # backing off after a failure, so new deletes do not hammer a failing
+    # Supabase with retries.
+    def wake(self):
+        if self._wake is not None and self.consecutive_failures == 0:
+            self._wake.set()
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                processed = await asyncio.to_thread(self.process_batch)
+            except Exception as e:
+                self.consecutive_failures += 1
+                self.last_error = str(e)
+                print(f"Error processing deletions: {e}")
+                delay = min(self.max_backoff, self.poll_seconds * 2 ** self.consecutive_failures)
+            else:
+                self.consecutive_failures = 0
+                self.last_error = None
+                # Keep going while there is a backlog
+                delay = 0 if processed == self.batch_size else self.poll_seconds
+            self.last_run = datetime.now(timezone.utc)
+
+            if delay and not self._stopping:
+                if self.consecutive_failures:
+                    # Drop wake-ups that arrived while the failing batch ran
+                    self._wake.clear()
+                try:
+                    await asyncio.wait_for(self._wake.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+            self._wake.clear()
+
+    # Remove the objects and rows of the oldest pending deletes; returns how
+    # many were processed
+    def process_batch(self) -> int:
+        response = supabase.table("audio_files").select("id, storage_path") \
+            .not_.is_("deleted_at", "null").order("deleted_at").limit(self.batch_size).execute()
+        if not response.data:
+            return 0
+
+        delete_audio_files([row["storage_path"] for row in response.data])
+        ids = [row["id"] for row in response.data]
+        supabase.table("audio_files").delete().in_("id", ids).execute()
+        return len(ids)
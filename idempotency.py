@@ -0,0 +1,80 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Tuple
+
+
+class IdempotencyConflict(Exception):
+    pass
+
+
+class _Pending:
+    def __init__(self, fingerprint: Hashable):
+        self.fingerprint = fingerprint
+        self.finished = asyncio.Event()
+
+
+# Remembers the result of requests sent with an Idempotency-Key.
+#
+# The first request with a key runs the operation; a retry with the same key
+# gets the stored result back without running it again, and a duplicate that
+# arrives while the first is still running waits for it instead of racing it.
+# Only successful results are stored, so a retry after a failure runs the
+# operation again. Results are kept for ttl_seconds, and at most max_entries
+# of them (oldest dropped first).
+class IdempotencyStore:
+    def __init__(self, ttl_seconds: float = 86400, max_entries: int = 10000):
+        self.ttl = ttl_seconds
+        self.max_entries = max_entries
+        self._pending: Dict[str, _Pending] = {}
+        self._completed: "OrderedDict[str, Tuple[Hashable, Any, float]]" = OrderedDict()
+
+    # Run `operation` once per key; returns (result, replayed). The fingerprint
+    # identifies the request so a key reused for a different one is rejected.
+    async def run(self, key: str, fingerprint: Hashable,
+                  operation: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        while True:
+            self._purge()
+
+            if key in self._completed:
+                stored_fingerprint, result, _ = self._completed[key]
+                self._check(stored_fingerprint, fingerprint)
+                return result, True
+
+            pending = self._pending.get(key)
+            if pending is None:
+                break
+            self._check(pending.fingerprint, fingerprint)
+            # Wait for the request in progress, then look again: it has either
+            # stored its result or failed and left the key free
+            await pending.finished.wait()
+
+        pending = _Pending(fingerprint)
+        self._pending[key] = pending
+        try:
+            result = await operation()
+            self._completed[key] = (fingerprint, result, time.monotonic() + self.ttl)
+            self._purge()
+            return result, False
+        finally:
+            del self._pending[key]
+            pending.finished.set()
+
+    # Forget stored results for which `matches(result)` is true, so retries of
+    # those requests run again. Scans at most max_entries results.
+    def evict(self, matches: Callable[[Any], bool]):
+        for key in [key for key, (_, result, _) in self._completed.items() if matches(result)]:
+            del self._completed[key]
+
+    def _check(self, stored_fingerprint: Hashable, fingerprint: Hashable):
+        if stored_fingerprint != fingerprint:
+            raise IdempotencyConflict("Idempotency-Key was already used for a different request")
+
+    # Entries are kept in completion order, so expired ones are at the front
+    def _purge(self):
+        now = time.monotonic()
+        while self._completed:
+            key, (_, _, expires_at) = next(iter(self._completed.items()))
+            if expires_at > now and len(self._completed) <= self.max_entries:
+                break
+            del self._completed[key]
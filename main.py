@@ -1,26 +1,59 @@
-from fastapi import FastAPI, UploadFile, File, HTTPException, Depends
-from fastapi.responses import Response
-from typing import List
+from fastapi import FastAPI, UploadFile, File, HTTPException, Depends, Header
+from fastapi.responses import Response, StreamingResponse
+from typing import List, Optional
+import asyncio
+import json
 import uuid
 from datetime import datetime, timezone
-from config import supabase
-from models import AudioFile, AudioFileCreate
+from config import (
+    supabase,
+    METADATA_BATCH_ENABLED,
+    METADATA_BATCH_MAX_ROWS,
+    METADATA_BATCH_MAX_DELAY_MS,
+    METADATA_BATCH_QUEUE_SIZE,
+    EXPORT_PAGE_SIZE,
+    IDEMPOTENCY_TTL_SECONDS,
+    IDEMPOTENCY_MAX_KEYS,
+    DELETE_BATCH_SIZE,
+    DELETE_POLL_SECONDS,
+    DELETE_MAX_BACKOFF_SECONDS
+)
+from metadata_writer import MetadataBatchWriter
+from stats import StatsAggregator
+from idempotency import IdempotencyStore, IdempotencyConflict
+from profiling import install_profiler, timed
+from deletion_worker import DeletionWorker
+from models import AudioFile, AudioFileCreate, StorageStats, DeletionStatus, parse_timestamp
 from storage import (
     upload_audio_file,
     list_audio_files,
     get_audio_file,
     download_audio_file,
     delete_audio_file,
+    iter_metadata_pages,
     AUDIO_BUCKET
 )
 import os
 
+# Use orjson for the export stream when it is installed
+try:
+    import orjson
+
+    def encode_ndjson(rows: List[dict]) -> bytes:
+        return b"".join(orjson.dumps(row) + b"\n" for row in rows)
+except ImportError:
+    def encode_ndjson(rows: List[dict]) -> bytes:
+        return "".join(json.dumps(row, separators=(",", ":")) + "\n" for row in rows).encode()
+
 app = FastAPI(
     title="Supabase Audio File Storage API",
     description="A simple API for CRUD operations on audio files using Supabase Storage",
     version="1.0.0"
 )
 
+# Opt-in per-request profiling (no middleware is added unless enabled)
+install_profiler(app)
+
 # Allowed audio file types
 ALLOWED_CONTENT_TYPES = [
     "audio/mpeg",     # MP3
@@ -32,6 +65,52 @@ ALLOWED_CONTENT_TYPES = [
     "audio/mp4",      # M4A
 ]
 
+# Optional group-commit writer for audio_files inserts
+metadata_writer = MetadataBatchWriter(
+    "audio_files",
+    max_rows=METADATA_BATCH_MAX_ROWS,
+    max_delay_ms=METADATA_BATCH_MAX_DELAY_MS,
+    max_queue=METADATA_BATCH_QUEUE_SIZE
+) if METADATA_BATCH_ENABLED else None
+
+# Running totals served by /stats
+storage_stats = StatsAggregator()
+
+# Results of uploads sent with an Idempotency-Key, replayed on retry
+idempotency_store = IdempotencyStore(
+    ttl_seconds=IDEMPOTENCY_TTL_SECONDS,
+    max_entries=IDEMPOTENCY_MAX_KEYS
+)
+
+# Finishes deletes in the background (DELETE /files/{id} only marks the row)
+deletion_worker = DeletionWorker(
+    batch_size=DELETE_BATCH_SIZE,
+    poll_seconds=DELETE_POLL_SECONDS,
+    max_backoff_seconds=DELETE_MAX_BACKOFF_SECONDS
+)
+
+# Background task computing the /stats totals (retried until it succeeds)
+stats_seed_task = None
+
+@app.on_event("startup")
+async def start_background_tasks():
+    global stats_seed_task
+    stats_seed_task = asyncio.create_task(storage_stats.seed_until_ready())
+
+    await deletion_worker.start()
+    if metadata_writer is not None:
+        await metadata_writer.start()
+
+@app.on_event("shutdown")
+async def stop_background_tasks():
+    if stats_seed_task is not None:
+        stats_seed_task.cancel()
+    await deletion_worker.stop()
+    
+    # Flush any metadata rows still waiting to be written
+    if metadata_writer is not None:
+        await metadata_writer.stop()
+
 # Health check endpoint
 @app.get("/")
 async def health_check():
@@ -39,7 +118,11 @@ async def health_check():
 
 # Upload an audio file
 @app.post("/upload", response_model=AudioFile)
-async def upload_file(file: UploadFile = File(...)):
+async def upload_file(
+    response: Response,
+    file: UploadFile = File(...),
+    idempotency_key: Optional[str] = Header(None)
+):
     # Validate file type
     if file.content_type not in ALLOWED_CONTENT_TYPES:
         raise HTTPException(
@@ -54,12 +137,34 @@ async def upload_file(file: UploadFile = File(...)):
             detail="File name is required"
         )
     
+    if idempotency_key is None:
+        return await save_upload(file)
+    
+    # A retry with the same key gets the original result back, and a
+    # duplicate sent while the original is still running waits for it
+    try:
+        result, replayed = await idempotency_store.run(
+            idempotency_key,
+            (file.filename, file.content_type, file.size),
+            lambda: save_upload(file)
+        )
+    except IdempotencyConflict as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    
+    if replayed:
+        response.headers["Idempotent-Replayed"] = "true"
+    return result
+
+# Store an uploaded file and its metadata
+async def save_upload(file: UploadFile) -> AudioFile:
     try:
         # Read file content
         file_content = await file.read()
         
-        # Upload to Supabase Storage
-        upload_result = upload_audio_file(
+        # Upload to Supabase Storage (off the event loop so concurrent
+        # uploads can overlap)
+        upload_result = await asyncio.to_thread(
+            upload_audio_file,
             file_content=file_content,
             filename=file.filename,
             content_type=file.content_type
@@ -75,8 +180,17 @@ async def upload_file(file: UploadFile = File(...)):
             "storage_path": upload_result["storage_path"]
         }
         
-        # Insert metadata into Supabase database
-        result = supabase.table("audio_files").insert(metadata).execute()
+        # Insert metadata into Supabase database, coalesced with other
+        # concurrent uploads when batching is enabled
+        with timed("db"):
+            if metadata_writer is not None:
+                await metadata_writer.insert(metadata)
+            else:
+                await asyncio.to_thread(
+                    lambda: supabase.table("audio_files").insert(metadata).execute()
+                )
+        
+        storage_stats.record_upload(metadata["id"], metadata["content_type"], metadata["size"])
         
         # Return the created file metadata
         return AudioFile(**metadata)
@@ -84,22 +198,52 @@ async def upload_file(file: UploadFile = File(...)):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error uploading file: {str(e)}")
 
+# Get storage statistics (file count and bytes, overall and per content type)
+@app.get("/stats", response_model=StorageStats)
+async def get_stats():
+    if not storage_stats.ready:
+        raise HTTPException(status_code=503, detail="Storage statistics are not available yet")
+    return storage_stats.snapshot()
+
 # List all audio files
 @app.get("/files", response_model=List[AudioFile])
 async def list_files():
     try:
         # Get files from Supabase database
-        response = supabase.table("audio_files").select("*").execute()
+        with timed("db"):
+            response = supabase.table("audio_files").select("*").is_("deleted_at", "null").execute()
         return response.data
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error listing files: {str(e)}")
 
+# Export every file's metadata as newline-delimited JSON, one page at a time
+@app.get("/files/export")
+async def export_files():
+    # Only the public AudioFile columns, not internal ones such as deleted_at
+    columns = ", ".join(AudioFile.model_fields)
+    pages = iter_metadata_pages(columns, page_size=EXPORT_PAGE_SIZE)
+    try:
+        # Fetch the first page up front so a database error is still
+        # reported as a 500 instead of an empty stream
+        with timed("db"):
+            first_page = await asyncio.to_thread(next, pages, [])
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error exporting files: {str(e)}")
+    
+    def stream():
+        yield encode_ndjson(first_page)
+        for page in pages:
+            yield encode_ndjson(page)
+    
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
 # Get a specific audio file info
 @app.get("/files/{file_id}", response_model=AudioFile)
 async def get_file(file_id: str):
     try:
         # Get file from Supabase database
-        response = supabase.table("audio_files").select("*").eq("id", file_id).execute()
+        with timed("db"):
+            response = supabase.table("audio_files").select("*").eq("id", file_id).is_("deleted_at", "null").execute()
         
         if not response.data:
             raise HTTPException(status_code=404, detail="File not found")
@@ -115,7 +259,8 @@ async def get_file(file_id: str):
 async def download_file(file_id: str):
     try:
         # Get file info from database
-        response = supabase.table("audio_files").select("storage_path, filename, content_type").eq("id", file_id).execute()
+        with timed("db"):
+            response = supabase.table("audio_files").select("storage_path, filename, content_type").eq("id", file_id).is_("deleted_at", "null").execute()
         
         if not response.data:
             raise HTTPException(status_code=404, detail="File not found")
@@ -140,29 +285,57 @@ async def download_file(file_id: str):
         raise HTTPException(status_code=500, detail=f"Error downloading file: {str(e)}")
 
 # Delete an audio file
-@app.delete("/files/{file_id}")
+@app.delete("/files/{file_id}", status_code=202)
 async def delete_file(file_id: str):
     try:
-        # Get file info from database
-        response = supabase.table("audio_files").select("storage_path").eq("id", file_id).execute()
+        # Mark the row as deleted, which hides it from every read; the
+        # background worker removes the stored file and the row later
+        with timed("db"):
+            response = supabase.table("audio_files").update({
+                "deleted_at": datetime.now(timezone.utc).isoformat()
+            }).eq("id", file_id).is_("deleted_at", "null").execute()
         
         if not response.data:
             raise HTTPException(status_code=404, detail="File not found")
         
-        storage_path = response.data[0]["storage_path"]
-        
-        # Delete file from Supabase Storage
-        delete_audio_file(storage_path)
+        file_info = response.data[0]
+        storage_stats.record_delete(file_id, file_info["content_type"], file_info["size"] or 0)
+        deletion_worker.wake()
         
-        # Delete metadata from Supabase database
-        supabase.table("audio_files").delete().eq("id", file_id).execute()
+        # A retried upload must not hand back a file that is now deleted
+        idempotency_store.evict(lambda result: result.id == file_id)
         
-        return {"message": "File deleted successfully"}
+        return {"message": "File scheduled for deletion"}
     except HTTPException:
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error deleting file: {str(e)}")
 
+# Get the state of the background deletion queue
+@app.get("/deletions/status", response_model=DeletionStatus)
+async def deletion_status():
+    try:
+        with timed("db"):
+            response = supabase.table("audio_files").select("deleted_at", count="exact") \
+                .not_.is_("deleted_at", "null").order("deleted_at").limit(1).execute()
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error getting deletion status: {str(e)}")
+    
+    oldest = None
+    lag_seconds = 0.0
+    if response.data:
+        oldest = parse_timestamp(response.data[0]["deleted_at"])
+        lag_seconds = (datetime.now(timezone.utc) - oldest).total_seconds()
+    
+    return DeletionStatus(
+        pending=response.count or 0,
+        oldest_pending_at=oldest,
+        lag_seconds=lag_seconds,
+        consecutive_failures=deletion_worker.consecutive_failures,
+        last_error=deletion_worker.last_error,
+        last_run=deletion_worker.last_run
+    )
+
 # Create the audio_files table if it doesn't exist
 def create_audio_files_table():
     try:
@@ -182,6 +355,22 @@ def create_audio_files_table():
         - size (INTEGER)
         - upload_timestamp (TIMESTAMP)
         - storage_path (TEXT)
+        - deleted_at (TIMESTAMP, nullable)
+        
+        Index (used by the background deletion worker):
+        CREATE INDEX audio_files_pending_deletes ON audio_files (deleted_at) WHERE deleted_at IS NOT NULL;
+        """)
+        return
+    
+    try:
+        # Tables created before deletes became asynchronous lack deleted_at
+        supabase.table("audio_files").select("id, deleted_at").limit(1).execute()
+    except Exception as e:
+        print(f"Audio files table is missing the deleted_at column: {e}")
+        print("Please add it and its index in the SQL editor of your Supabase dashboard:")
+        print("""
+        ALTER TABLE audio_files ADD COLUMN deleted_at timestamptz;
+        CREATE INDEX audio_files_pending_deletes ON audio_files (deleted_at) WHERE deleted_at IS NOT NULL;
         """)
         
 # Initialize the table when the app starts
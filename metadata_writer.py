@@ -0,0 +1,133 @@
+import asyncio
+from typing import List, Optional, Tuple
+from config import supabase
+
+# Sentinel placed on the queue to tell the flush loop to drain and exit
+_STOP = object()
+
+
+# Group-commit writer for metadata rows.
+#
+# Concurrent uploads hand their row to insert() and wait on a future. A single
+# background task collects rows until max_rows are queued or max_delay_ms has
+# passed since the first one arrived, writes them with one bulk insert and
+# resolves each caller's future with its own row.
+class MetadataBatchWriter:
+    def __init__(self, table: str, max_rows: int = 50, max_delay_ms: int = 20, max_queue: int = 1000):
+        self.table = table
+        self.max_rows = max(1, max_rows)
+        self.max_delay = max(0, max_delay_ms) / 1000
+        self.max_queue = max_queue
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._closing = False
+
+    # Start the background flush loop (call from the app's startup hook)
+    async def start(self):
+        if self._task is not None:
+            return
+        self._closing = False
+        self._queue = asyncio.Queue(maxsize=self.max_queue)
+        self._task = asyncio.create_task(self._run())
+
+    # Flush everything still queued and stop the loop (call on shutdown)
+    async def stop(self):
+        if self._task is None:
+            return
+        self._closing = True
+        await self._queue.put(_STOP)
+        await self._task
+
+        # Uploads that were waiting for room in a full queue when stop() was
+        # called put their rows behind _STOP, so the loop never saw them.
+        # Taking an item lets the next waiting upload in; keep going until
+        # nothing is left so none of them waits forever.
+        drained = True
+        while drained:
+            drained = False
+            while not self._queue.empty():
+                _, future = self._queue.get_nowait()
+                _resolve(future, error=RuntimeError("Metadata writer is not running"))
+                drained = True
+            await asyncio.sleep(0)
+
+        self._task = None
+        self._queue = None
+
+    # Queue a row and wait until it has been written; returns the stored row.
+    # Blocks while the queue is full, which pushes back on new uploads.
+    async def insert(self, row: dict) -> dict:
+        if self._task is None or self._closing:
+            raise RuntimeError("Metadata writer is not running")
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((row, future))
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            item = await self._queue.get()
+            if item is _STOP:
+                break
+
+            batch = [item]
+            deadline = loop.time() + self.max_delay
+            while len(batch) < self.max_rows:
+                # Take whatever is already waiting before sleeping on the queue
+                try:
+                    item = self._queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    remaining = deadline - loop.time()
+                    if remaining <= 0:
+                        break
+                    try:
+                        item = await asyncio.wait_for(self._queue.get(), remaining)
+                    except asyncio.TimeoutError:
+                        break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+
+            await self._flush(batch)
+
+    async def _flush(self, batch: List[Tuple[dict, asyncio.Future]]):
+        rows = [row for row, _ in batch]
+        try:
+            response = await asyncio.to_thread(self._execute, rows)
+        except Exception as e:
+            if len(batch) == 1:
+                _resolve(batch[0][1], error=e)
+                return
+            # One bad row fails the whole bulk insert; retry the rows one by
+            # one so only the offending upload sees the error
+            for row, future in batch:
+                try:
+                    response = await asyncio.to_thread(self._execute, [row])
+                    _resolve(future, result=_stored_row(response, row))
+                except Exception as row_error:
+                    _resolve(future, error=row_error)
+            return
+
+        stored = {r.get("id"): r for r in (response.data or [])}
+        for row, future in batch:
+            _resolve(future, result=stored.get(row.get("id"), row))
+
+    def _execute(self, rows: List[dict]):
+        return supabase.table(self.table).insert(rows).execute()
+
+
+def _stored_row(response, row: dict) -> dict:
+    return response.data[0] if response.data else row
+
+
+# The caller may have gone away (client disconnect cancels the request), in
+# which case its future is already cancelled and must not be resolved again
+def _resolve(future: asyncio.Future, result: Optional[dict] = None, error: Optional[Exception] = None):
+    if future.done():
+        return
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
@@ -0,0 +1,156 @@
+"""Move existing audio files to the configured storage key layout.
+
+Rows in audio_files are read in id order, one page at a time. For every row
+whose storage_path is not in the target layout the object is copied to its
+new key (several copies run at once), storage_path is rewritten, and the old
+objects of the page are then removed with one batched request (if that
+fails the run goes on, and reconcile.py later finds the leftovers). The row is
+only rewritten if it still points at the old key, so files deleted or
+changed while the migration runs are left alone (and their copy is removed).
+
+The id of the last finished page is saved to a checkpoint file, so an
+interrupted run continues where it stopped. Rows that are already migrated
+are skipped, which makes re-running the tool safe.
+
+Usage:
+    python migrate_storage_layout.py --dry-run
+    python migrate_storage_layout.py --layout sharded --workers 16
+"""
+import argparse
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
+
+from config import supabase, STORAGE_KEY_LAYOUT
+from storage import (
+    iter_metadata_pages,
+    make_storage_path,
+    copy_audio_file,
+    delete_audio_files,
+    STORAGE_KEY_LAYOUTS
+)
+
+
+class LayoutMigration:
+    def __init__(self, layout: str, checkpoint_path: str, page_size: int,
+                 workers: int, dry_run: bool):
+        self.layout = layout
+        self.checkpoint_path = checkpoint_path
+        self.page_size = page_size
+        self.workers = workers
+        self.dry_run = dry_run
+        self.counts = {"rows": 0, "migrated": 0, "already_migrated": 0, "skipped": 0, "failed": 0,
+                       "not_removed": 0}
+
+    def run(self):
+        last_id = self._load_checkpoint()
+        columns = "id, filename, storage_path"
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for page in iter_metadata_pages(columns, last_id, self.page_size):
+                self._migrate_page(page, executor)
+                if not self.dry_run:
+                    self._save_checkpoint(page[-1]["id"])
+
+        print("Migration summary:")
+        for name, value in self.counts.items():
+            print(f"  {name}: {value}")
+        if self.dry_run:
+            print("Dry run: nothing was changed")
+        elif os.path.exists(self.checkpoint_path):
+            # A finished run starts from scratch next time
+            os.remove(self.checkpoint_path)
+
+    def _migrate_page(self, page: List[dict], executor: ThreadPoolExecutor):
+        moves = []
+        for row in page:
+            self.counts["rows"] += 1
+            new_path = make_storage_path(row["id"], row["filename"], self.layout)
+            if row["storage_path"] == new_path:
+                self.counts["already_migrated"] += 1
+            else:
+                moves.append((row["id"], row["storage_path"], new_path))
+
+        if self.dry_run:
+            for _, old_path, new_path in moves:
+                print(f"{old_path} -> {new_path}")
+            self.counts["migrated"] += len(moves)
+            return
+
+        results = list(executor.map(lambda move: self._move(*move), moves))
+        for status, _ in results:
+            self.counts[status] += 1
+
+        # The old object is garbage once its row points at the new one; the new
+        # copy is garbage if the row changed or disappeared in the meantime
+        garbage = [path for _, path in results if path is not None]
+        try:
+            delete_audio_files(garbage)
+        except Exception as e:
+            # The rows are already repointed, so carry on; the objects left
+            # behind are orphans that reconcile.py will find
+            print(f"Error removing {len(garbage)} old objects: {e}")
+            self.counts["not_removed"] += len(garbage)
+
+    # Copy one object and repoint its row; returns the outcome and the key
+    # that is no longer referenced (None if the move failed)
+    def _move(self, file_id: str, old_path: str, new_path: str) -> Tuple[str, Optional[str]]:
+        try:
+            try:
+                copy_audio_file(old_path, new_path)
+            except Exception as e:
+                # Left behind by an interrupted run
+                if "Duplicate" not in str(e) and "already exists" not in str(e):
+                    raise
+
+            response = supabase.table("audio_files").update({"storage_path": new_path}) \
+                .eq("id", file_id).eq("storage_path", old_path).execute()
+        except Exception as e:
+            print(f"Error migrating {old_path}: {e}")
+            return "failed", None
+
+        if not response.data:
+            return "skipped", new_path
+        return "migrated", old_path
+
+    def _load_checkpoint(self) -> Optional[str]:
+        if not os.path.exists(self.checkpoint_path):
+            return None
+        with open(self.checkpoint_path) as f:
+            last_id = json.load(f)["last_id"]
+        print(f"Resuming after id {last_id}")
+        return last_id
+
+    def _save_checkpoint(self, last_id: str):
+        tmp_path = f"{self.checkpoint_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"last_id": last_id}, f)
+        os.replace(tmp_path, self.checkpoint_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Move audio files to a new storage key layout")
+    parser.add_argument("--layout", choices=STORAGE_KEY_LAYOUTS, default=STORAGE_KEY_LAYOUT,
+                        help="target layout (defaults to STORAGE_KEY_LAYOUT)")
+    parser.add_argument("--checkpoint", default="migrate_checkpoint.json",
+                        help="file progress is saved to for resuming")
+    parser.add_argument("--page-size", type=int, default=500,
+                        help="rows migrated per batch")
+    parser.add_argument("--workers", type=int, default=8,
+                        help="objects copied at the same time")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="only print the moves that would be made")
+    args = parser.parse_args()
+
+    LayoutMigration(
+        layout=args.layout,
+        checkpoint_path=args.checkpoint,
+        page_size=args.page_size,
+        workers=args.workers,
+        dry_run=args.dry_run
+    ).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,6 @@
-from pydantic import BaseModel
-from typing import Optional
-from datetime import datetime
+from pydantic import BaseModel, TypeAdapter
+from typing import Dict, Optional
+from datetime import datetime, timezone
 import uuid
 
 class AudioFileBase(BaseModel):
@@ -18,3 +18,30 @@ class AudioFile(AudioFileBase):
 
     class Config:
         from_attributes = True
+
+class ContentTypeStats(BaseModel):
+    count: int
+    bytes: int
+
+class StorageStats(BaseModel):
+    total_files: int
+    total_bytes: int
+    by_content_type: Dict[str, ContentTypeStats]
+
+class DeletionStatus(BaseModel):
+    pending: int
+    oldest_pending_at: Optional[datetime]
+    lag_seconds: float
+    consecutive_failures: int
+    last_error: Optional[str]
+    last_run: Optional[datetime]
+
+_datetime_adapter = TypeAdapter(datetime)
+
+# Parse a timestamp returned by PostgREST or Supabase Storage. Timestamps
+# without a zone are taken to be UTC. Raises ValueError if it cannot be parsed.
+def parse_timestamp(value: str) -> datetime:
+    parsed = _datetime_adapter.validate_python(value)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed
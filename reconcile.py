@@ -0,0 +1,404 @@
+"""Find and remove orphans between the audio-files bucket and the audio_files table.
+
+An orphan object is a storage object that no metadata row points to (for
+example an upload whose row insert failed). An orphan row is a metadata row
+whose storage object is gone (for example a delete that failed half way).
+
+The bucket and the table are paged concurrently, each in its own thread, and
+merged by file id: object keys in both the flat ("<id>_<filename>") and the
+sharded ("<ab>/<cd>/<id>") layout sort in file id order and rows are read in
+id order, so both streams arrive sorted and a single merge pass finds every
+orphan while holding only a few pages in memory.
+
+Orphans are written to a report file (one JSON object per line). With
+--delete they are then removed in batches, after being re-checked against
+the current state so that anything fixed in the meantime is left alone.
+Progress is saved to a checkpoint file, so an interrupted run picks up where
+it stopped when started again with the same arguments.
+
+Usage:
+    python reconcile.py                      # dry run, report only
+    python reconcile.py --delete             # report, then remove orphans
+    python reconcile.py --min-age-minutes 120 --report orphans.jsonl
+"""
+import argparse
+import heapq
+import json
+import os
+import queue
+import threading
+from datetime import datetime, timedelta, timezone
+from typing import Iterator, Optional
+
+from config import supabase, AUDIO_BUCKET
+from models import parse_timestamp
+from storage import (
+    iter_audio_files,
+    iter_metadata_rows,
+    delete_audio_files,
+    file_id_from_storage_path
+)
+
+# Marks the end of a producer's stream
+_END = object()
+
+
+class _ProducerError:
+    def __init__(self, error: Exception):
+        self.error = error
+
+
+# Run a generator in a background thread, buffering at most `max_items` of
+# its output so a fast producer cannot outrun the merge
+def _prefetch(source: Iterator, max_items: int) -> Iterator:
+    buffer = queue.Queue(maxsize=max_items)
+
+    def produce():
+        try:
+            for item in source:
+                buffer.put(item)
+            buffer.put(_END)
+        except Exception as e:
+            buffer.put(_ProducerError(e))
+
+    threading.Thread(target=produce, daemon=True).start()
+
+    while True:
+        item = buffer.get()
+        if item is _END:
+            return
+        if isinstance(item, _ProducerError):
+            raise item.error
+        yield item
+
+
+# Storage and PostgREST timestamps; None for a missing or malformed one
+def _parse_timestamp(value: Optional[str]) -> Optional[datetime]:
+    try:
+        return parse_timestamp(value)
+    except ValueError:
+        return None
+
+
+class Reconciler:
+    def __init__(self, report_path: str, checkpoint_path: str, page_size: int,
+                 batch_size: int, min_age: timedelta, delete: bool):
+        self.report_path = report_path
+        self.checkpoint_path = checkpoint_path
+        self.page_size = page_size
+        self.batch_size = batch_size
+        self.delete = delete
+        self.cutoff = datetime.now(timezone.utc) - min_age
+        self.counts = {
+            "objects": 0,
+            "rows": 0,
+            "orphan_objects": 0,
+            "orphan_rows": 0,
+            "unknown_objects": 0,
+            "skipped_recent": 0,
+            "deleted_objects": 0,
+            "deleted_rows": 0
+        }
+        self.state = {
+            "last_id": None,
+            "root_offset": 0,
+            "report_offset": 0,
+            "scan_complete": False,
+            "delete_offset": 0,
+            # Path of the last unknown object reported from each listing
+            "flat_unknown_through": None,
+            "sharded_unknown_through": None
+        }
+
+    def run(self):
+        self._load_checkpoint()
+
+        if not self.state["scan_complete"]:
+            self._scan()
+
+        if self.delete:
+            self._remove_orphans()
+
+        self._print_summary()
+
+    # --- checkpointing -------------------------------------------------
+
+    def _load_checkpoint(self):
+        if not os.path.exists(self.checkpoint_path):
+            return
+        with open(self.checkpoint_path) as f:
+            self.state.update(json.load(f))
+        print(f"Resuming from checkpoint {self.checkpoint_path}: {self.state}")
+
+    def _save_checkpoint(self):
+        tmp_path = f"{self.checkpoint_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.state, f)
+        os.replace(tmp_path, self.checkpoint_path)
+
+    # --- scan ----------------------------------------------------------
+
+    # Objects in the bucket root (the flat layout). `index` is the position
+    # in the root listing, which is what a resumed run restarts from.
+    def _flat_objects(self) -> Iterator[dict]:
+        offset = self.state["root_offset"]
+        for index, entry in enumerate(iter_audio_files("", offset, self.page_size), start=offset):
+            # Folder placeholders have no id
+            if entry.get("id") is None:
+                continue
+            obj = self._object(entry["name"], entry, index)
+            if obj is not None:
+                yield obj
+
+    # Objects in the <ab>/<cd>/ folders of the sharded layout. Every possible
+    # top-level folder is listed, skipping those a resumed run is already past.
+    def _sharded_objects(self) -> Iterator[dict]:
+        last_id = self.state["last_id"] or ""
+        for top in (f"{n:02x}" for n in range(256)):
+            if top < last_id[0:2]:
+                continue
+            for folder in iter_audio_files(top, 0, self.page_size):
+                if folder.get("id") is not None:
+                    continue
+                sub = folder["name"]
+                if top == last_id[0:2] and sub < last_id[2:4]:
+                    continue
+                prefix = f"{top}/{sub}"
+                for entry in iter_audio_files(prefix, 0, self.page_size):
+                    if entry.get("id") is None:
+                        continue
+                    obj = self._object(f"{prefix}/{entry['name']}", entry, None)
+                    if obj is not None:
+                        yield obj
+
+    def _object(self, path: str, entry: dict, index: Optional[int]) -> Optional[dict]:
+        file_id = file_id_from_storage_path(path)
+        last_id = self.state["last_id"]
+        if file_id is not None and last_id is not None and file_id <= last_id:
+            return None
+        return {
+            "id": file_id,
+            "path": path,
+            "created_at": entry.get("created_at"),
+            "index": index
+        }
+
+    def _row_stream(self) -> Iterator[dict]:
+        columns = "id, storage_path, upload_timestamp"
+        # Rows waiting to be deleted still own their object
+        for row in iter_metadata_rows(columns, self.state["last_id"], self.page_size, include_deleted=True):
+            yield row
+
+    def _scan(self):
+        report = open(self.report_path, "a+")
+        report.seek(self.state["report_offset"])
+        report.truncate()
+
+        # Both layouts may be present while a migration is under way; each
+        # listing is in id order on its own, so merge them into one stream
+        objects = self._ids_in_order(
+            heapq.merge(
+                self._known_objects(_prefetch(self._flat_objects(), self.page_size * 2), "flat", report),
+                self._known_objects(_prefetch(self._sharded_objects(), self.page_size * 2), "sharded", report),
+                key=lambda obj: obj["id"]
+            ),
+            "bucket", strict=False
+        )
+        rows = self._ids_in_order(
+            _prefetch(self._row_stream(), self.page_size * 2),
+            "table", strict=True
+        )
+
+        next_object = next(objects, None)
+        next_row = next(rows, None)
+        merged = 0
+
+        while next_object is not None or next_row is not None:
+            if next_row is None or (next_object is not None and next_object["id"] < next_row["id"]):
+                current_id = next_object["id"]
+                row = None
+            else:
+                current_id = next_row["id"]
+                row = next_row
+                next_row = next(rows, None)
+
+            # Collect every object stored under this id
+            group = []
+            while next_object is not None and next_object["id"] == current_id:
+                group.append(next_object)
+                next_object = next(objects, None)
+
+            self._compare(current_id, row, group, report)
+
+            root_indexes = [obj["index"] for obj in group if obj["index"] is not None]
+            if root_indexes:
+                self.state["root_offset"] = root_indexes[-1] + 1
+            self.state["last_id"] = current_id
+            merged += 1
+            if merged % self.page_size == 0:
+                self._checkpoint_scan(report)
+
+        self.state["scan_complete"] = True
+        self._checkpoint_scan(report)
+        report.close()
+
+    # Report objects whose names were not written by this API; they cannot be
+    # matched to a row and are never deleted. Each listing is in path order,
+    # and a resumed run lists the objects past its checkpoint again, so skip
+    # the unknown objects it has already reported.
+    def _known_objects(self, objects: Iterator[dict], layout: str, report) -> Iterator[dict]:
+        reported_key = f"{layout}_unknown_through"
+        for obj in objects:
+            self.counts["objects"] += 1
+            if obj["id"] is None:
+                reported_through = self.state[reported_key]
+                if reported_through is None or obj["path"] > reported_through:
+                    self.counts["unknown_objects"] += 1
+                    self._report(report, {"kind": "unknown", "path": obj["path"]})
+                    self.state[reported_key] = obj["path"]
+                continue
+            yield obj
+
+    # The merge relies on Python and the server agreeing on the order of ids,
+    # so refuse to go on rather than misreport if they ever do not
+    def _ids_in_order(self, items: Iterator[dict], source: str, strict: bool) -> Iterator[dict]:
+        previous = None
+        for item in items:
+            if previous is not None and (item["id"] < previous or (strict and item["id"] == previous)):
+                raise RuntimeError(
+                    f"The {source} listing is not sorted by file id "
+                    f"({item['id']!r} after {previous!r}); aborting"
+                )
+            previous = item["id"]
+            yield item
+
+    def _compare(self, file_id: str, row: Optional[dict], group: list, report):
+        if row is not None:
+            self.counts["rows"] += 1
+
+        paths = {obj["path"] for obj in group}
+        for obj in group:
+            if row is not None and obj["path"] == row["storage_path"]:
+                continue
+            if not self._is_old(obj["created_at"]):
+                self.counts["skipped_recent"] += 1
+                continue
+            self.counts["orphan_objects"] += 1
+            self._report(report, {"kind": "object", "id": file_id, "path": obj["path"]})
+
+        if row is not None and row["storage_path"] not in paths:
+            if not self._is_old(row.get("upload_timestamp")):
+                self.counts["skipped_recent"] += 1
+                return
+            self.counts["orphan_rows"] += 1
+            self._report(report, {"kind": "row", "id": file_id, "path": row["storage_path"]})
+
+    # Anything newer than the cutoff may belong to an upload or delete that is
+    # still in progress, so it is left for a later run
+    def _is_old(self, timestamp: Optional[str]) -> bool:
+        parsed = _parse_timestamp(timestamp)
+        return parsed is not None and parsed < self.cutoff
+
+    def _report(self, report, entry: dict):
+        report.write(json.dumps(entry) + "\n")
+        if not self.delete:
+            print(f"orphan {entry['kind']}: {entry['path']}")
+
+    def _checkpoint_scan(self, report):
+        report.flush()
+        self.state["report_offset"] = report.tell()
+        self._save_checkpoint()
+
+    # --- removal -------------------------------------------------------
+
+    def _remove_orphans(self):
+        with open(self.report_path) as report:
+            report.seek(self.state["delete_offset"])
+            while True:
+                lines = []
+                for _ in range(self.batch_size):
+                    line = report.readline()
+                    if not line:
+                        break
+                    lines.append(json.loads(line))
+                if not lines:
+                    break
+
+                self._remove_objects([e["path"] for e in lines if e["kind"] == "object"])
+                self._remove_rows([e for e in lines if e["kind"] == "row"])
+
+                self.state["delete_offset"] = report.tell()
+                self._save_checkpoint()
+
+    def _remove_objects(self, paths: list):
+        if not paths:
+            return
+        # Skip objects a row has started pointing to since the scan
+        response = supabase.table("audio_files").select("storage_path").in_("storage_path", paths).execute()
+        referenced = {row["storage_path"] for row in response.data}
+        paths = [path for path in paths if path not in referenced]
+        delete_audio_files(paths)
+        self.counts["deleted_objects"] += len(paths)
+
+    def _remove_rows(self, entries: list):
+        if not entries:
+            return
+        ids = [entry["id"] for entry in entries]
+        response = supabase.table("audio_files").select("id, storage_path").in_("id", ids).execute()
+        current = {row["id"]: row["storage_path"] for row in response.data}
+
+        # Skip rows that were rewritten since the scan or whose object exists
+        ids = [
+            entry["id"] for entry in entries
+            if current.get(entry["id"]) == entry["path"] and not _object_exists(entry["path"])
+        ]
+        if ids:
+            supabase.table("audio_files").delete().in_("id", ids).execute()
+        self.counts["deleted_rows"] += len(ids)
+
+    def _print_summary(self):
+        print("Reconciliation summary:")
+        for name, value in self.counts.items():
+            print(f"  {name}: {value}")
+        print(f"Report written to {self.report_path}")
+        if not self.delete:
+            print("Dry run: nothing was deleted (use --delete to remove orphans)")
+
+
+def _object_exists(storage_path: str) -> bool:
+    folder, _, name = storage_path.rpartition("/")
+    entries = supabase.storage.from_(AUDIO_BUCKET).list(folder, {"limit": 100, "search": name})
+    return any(entry["name"] == name for entry in entries)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Find and remove orphaned audio files and metadata rows")
+    parser.add_argument("--delete", action="store_true",
+                        help="remove the orphans found (default is a dry run that only reports them)")
+    parser.add_argument("--report", default="reconcile_report.jsonl",
+                        help="file the orphans are written to")
+    parser.add_argument("--checkpoint", default="reconcile_checkpoint.json",
+                        help="file progress is saved to for resuming")
+    parser.add_argument("--page-size", type=int, default=1000,
+                        help="objects or rows fetched per request")
+    parser.add_argument("--batch-size", type=int, default=100,
+                        help="orphans removed per request")
+    parser.add_argument("--min-age-minutes", type=int, default=60,
+                        help="ignore objects and rows newer than this")
+    args = parser.parse_args()
+
+    Reconciler(
+        report_path=args.report,
+        checkpoint_path=args.checkpoint,
+        page_size=args.page_size,
+        batch_size=args.batch_size,
+        min_age=timedelta(minutes=args.min_age_minutes),
+        delete=args.delete
+    ).run()
+
+    # A finished run starts from scratch next time
+    os.remove(args.checkpoint)
+
+
+if __name__ == "__main__":
+    main()
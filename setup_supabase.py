@@ -37,7 +37,10 @@ def create_audio_files_table():
         print("   - size (Integer)")
         print("   - upload_timestamp (Timestamp)")
         print("   - storage_path (Text)")
+        print("   - deleted_at (Timestamp, nullable)")
         print("6. Click 'Save'")
+        print("7. In the SQL editor, add the index used by the background deletion worker:")
+        print("   CREATE INDEX audio_files_pending_deletes ON audio_files (deleted_at) WHERE deleted_at IS NOT NULL;")
         return False
 
 def create_audio_files_bucket():
@@ -0,0 +1,91 @@
+import asyncio
+import threading
+from typing import Dict, Optional
+from storage import iter_metadata_pages
+
+
+# Running totals of the audio_files table.
+#
+# The totals are computed by seed() and then kept up to date by the upload
+# and delete handlers, so reading them never touches the database. They only
+# see changes made through this process, which matches the single-worker
+# deployment in the Dockerfile.
+#
+# Seeding pages through the table in id order while uploads and deletes keep
+# coming in. A change to a row the scan has already passed is applied to the
+# partial totals; a change to a row further on is skipped, because the scan
+# will read that row in its new state.
+class StatsAggregator:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._by_content_type: Dict[str, Dict[str, int]] = {}
+        self._total_files = 0
+        self._total_bytes = 0
+        # Last id read by the seed in progress ("" before its first page),
+        # None before seeding has started
+        self._seeded_through: Optional[str] = None
+        self.ready = False
+
+    # Page through the table and rebuild the totals from scratch
+    def seed(self, page_size: int = 1000):
+        with self._lock:
+            self._by_content_type = {}
+            self._total_files = 0
+            self._total_bytes = 0
+            self._seeded_through = ""
+            self.ready = False
+
+        for page in iter_metadata_pages("id, content_type, size", page_size=page_size):
+            with self._lock:
+                for row in page:
+                    self._add(row["content_type"], 1, row["size"] or 0)
+                self._seeded_through = page[-1]["id"]
+
+        with self._lock:
+            self.ready = True
+
+    # Run seed() until it succeeds, backing off between failed attempts.
+    # Meant to run as a background task so the server can start serving
+    # (with /stats unavailable) while the table is scanned.
+    async def seed_until_ready(self, max_backoff_seconds: float = 300):
+        delay = 1
+        while True:
+            try:
+                await asyncio.to_thread(self.seed)
+                return
+            except Exception as e:
+                print(f"Error seeding storage statistics, retrying in {delay}s: {e}")
+                await asyncio.sleep(delay)
+                delay = min(max_backoff_seconds, delay * 2)
+
+    def record_upload(self, file_id: str, content_type: str, size: int):
+        self._apply(file_id, content_type, 1, size)
+
+    def record_delete(self, file_id: str, content_type: str, size: int):
+        self._apply(file_id, content_type, -1, -size)
+
+    def _apply(self, file_id: str, content_type: str, count: int, size: int):
+        with self._lock:
+            if not self.ready and (self._seeded_through is None or file_id > self._seeded_through):
+                return
+            self._add(content_type, count, size)
+
+    def _add(self, content_type: str, count: int, size: int):
+        entry = self._by_content_type.setdefault(content_type, {"count": 0, "bytes": 0})
+        entry["count"] += count
+        entry["bytes"] += size
+        if entry["count"] <= 0:
+            del self._by_content_type[content_type]
+        self._total_files += count
+        self._total_bytes += size
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "total_files": self._total_files,
+                "total_bytes": self._total_bytes,
+                "by_content_type": {
+                    content_type: dict(entry)
+                    for content_type, entry in self._by_content_type.items()
+                }
+            }
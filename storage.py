@@ -1,14 +1,22 @@
 import os
-from typing import List, Optional
+import re
+from typing import Iterator, List, Optional
 try:
     from supabase import Client
 except ImportError:
     Client = None
-from config import supabase, AUDIO_BUCKET
+from config import supabase, AUDIO_BUCKET, STORAGE_KEY_LAYOUT, STORAGE_KEY_LAYOUTS
 from models import AudioFile
+from profiling import timed
 import uuid
 from datetime import datetime
 
+# Storage paths written by upload_audio_file, "<uuid>_<filename>" in the flat
+# layout and "<uuid[0:2]>/<uuid[2:4]>/<uuid>" in the sharded one
+_FILE_ID = r"[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}"
+FLAT_STORAGE_PATH = re.compile(rf"^({_FILE_ID})_")
+SHARDED_STORAGE_PATH = re.compile(rf"^[0-9a-f]{{2}}/[0-9a-f]{{2}}/({_FILE_ID})$")
+
 # Ensure the audio files bucket exists
 def create_audio_bucket():
     try:
@@ -43,14 +51,15 @@ def upload_audio_file(file_content: bytes, filename: str, content_type: str) ->
         file_id = str(uuid.uuid4())
         
         # Create the storage path
-        storage_path = f"{file_id}_{filename}"
+        storage_path = make_storage_path(file_id, filename)
         
         # Upload the file to Supabase Storage
-        response = supabase.storage.from_(AUDIO_BUCKET).upload(
-            path=storage_path,
-            file=file_content,
-            file_options={"content-type": content_type}
-        )
+        with timed("storage"):
+            response = supabase.storage.from_(AUDIO_BUCKET).upload(
+                path=storage_path,
+                file=file_content,
+                file_options={"content-type": content_type}
+            )
         
         return {
             "id": file_id,
@@ -61,14 +70,76 @@ def upload_audio_file(file_content: bytes, filename: str, content_type: str) ->
     except Exception as e:
         raise Exception(f"Error uploading file: {str(e)}")
 
+# Build the storage path for a new file.
+#
+# The sharded layout spreads objects over 65536 folders named after the first
+# four hex digits of the (random) uuid and keeps the user-supplied filename
+# out of the key. Because the folders are a prefix of the id, listing the
+# bucket in name order still returns objects in file id order.
+def make_storage_path(file_id: str, filename: str, layout: str = STORAGE_KEY_LAYOUT) -> str:
+    if layout == "sharded":
+        return f"{file_id[0:2]}/{file_id[2:4]}/{file_id}"
+    if layout == "flat":
+        return f"{file_id}_{filename}"
+    raise ValueError(f"Unknown storage key layout: {layout}")
+
+# Get the file id an object was stored under, or None for foreign objects
+def file_id_from_storage_path(storage_path: str) -> Optional[str]:
+    match = SHARDED_STORAGE_PATH.match(storage_path) or FLAT_STORAGE_PATH.match(storage_path)
+    return match.group(1) if match else None
+
+# Page through the entries directly under a folder of the bucket, sorted by name
+def iter_audio_files(prefix: str = "", offset: int = 0, page_size: int = 1000) -> Iterator[dict]:
+    while True:
+        try:
+            page = supabase.storage.from_(AUDIO_BUCKET).list(prefix, {
+                "limit": page_size,
+                "offset": offset,
+                "sortBy": {"column": "name", "order": "asc"}
+            })
+        except Exception as e:
+            raise Exception(f"Error listing files: {str(e)}")
+
+        # The server may return fewer entries than asked for, so only an
+        # empty page marks the end
+        if not page:
+            return
+        for entry in page:
+            yield entry
+        offset += len(page)
+
 # Get list of all audio files
 def list_audio_files() -> List[dict]:
-    try:
-        # List all files in the bucket
-        response = supabase.storage.from_(AUDIO_BUCKET).list()
-        return response
-    except Exception as e:
-        raise Exception(f"Error listing files: {str(e)}")
+    return list(iter_audio_files())
+
+# Page through audio_files metadata ordered by id, starting after `after`.
+# Rows waiting to be deleted are skipped unless include_deleted is set.
+# PostgREST silently caps pages at the project's max rows setting, so a short
+# page does not mean the end of the table; only an empty page does.
+def iter_metadata_pages(columns: str = "*", after: Optional[str] = None, page_size: int = 1000,
+                        include_deleted: bool = False) -> Iterator[List[dict]]:
+    while True:
+        try:
+            query = supabase.table("audio_files").select(columns).order("id").limit(page_size)
+            if not include_deleted:
+                query = query.is_("deleted_at", "null")
+            if after is not None:
+                query = query.gt("id", after)
+            page = query.execute().data
+        except Exception as e:
+            raise Exception(f"Error listing metadata: {str(e)}")
+
+        if not page:
+            return
+        yield page
+        after = page[-1]["id"]
+
+# Same as iter_metadata_pages, one row at a time
+def iter_metadata_rows(columns: str = "*", after: Optional[str] = None, page_size: int = 1000,
+                       include_deleted: bool = False) -> Iterator[dict]:
+    for page in iter_metadata_pages(columns, after, page_size, include_deleted):
+        for row in page:
+            yield row
 
 # Get a specific audio file
 def get_audio_file(file_path: str) -> dict:
@@ -83,19 +154,41 @@ def get_audio_file(file_path: str) -> dict:
 def download_audio_file(file_path: str) -> bytes:
     try:
         # Download the file
-        response = supabase.storage.from_(AUDIO_BUCKET).download(file_path)
+        with timed("storage"):
+            response = supabase.storage.from_(AUDIO_BUCKET).download(file_path)
         return response
     except Exception as e:
         raise Exception(f"Error downloading file: {str(e)}")
 
+# Copy an audio file to a new path in the bucket
+def copy_audio_file(from_path: str, to_path: str) -> bool:
+    try:
+        with timed("storage"):
+            supabase.storage.from_(AUDIO_BUCKET).copy(from_path, to_path)
+        return True
+    except Exception as e:
+        raise Exception(f"Error copying file: {str(e)}")
+
 # Delete an audio file
 def delete_audio_file(file_path: str) -> bool:
     try:
         # Delete the file from storage
-        supabase.storage.from_(AUDIO_BUCKET).remove([file_path])
+        with timed("storage"):
+            supabase.storage.from_(AUDIO_BUCKET).remove([file_path])
         return True
     except Exception as e:
         raise Exception(f"Error deleting file: {str(e)}")
 
+# Delete several audio files with a single storage request
+def delete_audio_files(file_paths: List[str]) -> bool:
+    if not file_paths:
+        return True
+    try:
+        with timed("storage"):
+            supabase.storage.from_(AUDIO_BUCKET).remove(file_paths)
+        return True
+    except Exception as e:
+        raise Exception(f"Error deleting files: {str(e)}")
+
 # Initialize the bucket when this module is imported
 create_audio_bucket()
@@ -3,6 +3,7 @@ import requests
 import time
 import os
 import json
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, Any
 
 # Base URL for the API
@@ -56,6 +57,10 @@ class TestAPIEndpoints:
         assert data["size"] == len(TEST_WAV_CONTENT)
         assert "upload_timestamp" in data
         assert "storage_path" in data
+        # The default sharded layout keeps the user-supplied filename out of
+        # the object key
+        assert "test_audio.wav" not in data["storage_path"]
+        assert data["storage_path"] == f"{data['id'][0:2]}/{data['id'][2:4]}/{data['id']}"
     
     def test_upload_mp3_file(self):
         """Test uploading an MP3 file"""
@@ -86,6 +91,59 @@ class TestAPIEndpoints:
         assert "upload_timestamp" in data
         assert "storage_path" in data
     
+    def test_concurrent_uploads(self):
+        """Test that concurrent uploads each get their own metadata row"""
+        def upload(index):
+            files = {
+                'file': (f'concurrent_{index}.wav', TEST_WAV_CONTENT, 'audio/wav')
+            }
+            return requests.post(f"{BASE_URL}/upload", files=files)
+        
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            responses = list(executor.map(upload, range(8)))
+        
+        assert all(response.status_code == 200 for response in responses)
+        uploaded = [response.json() for response in responses]
+        assert len({data["id"] for data in uploaded}) == len(uploaded)
+        assert sorted(data["filename"] for data in uploaded) == sorted(
+            f"concurrent_{index}.wav" for index in range(8)
+        )
+        
+        # Every row must be readable back
+        for data in uploaded:
+            response = requests.get(f"{BASE_URL}/files/{data['id']}")
+            assert response.status_code == 200
+            requests.delete(f"{BASE_URL}/files/{data['id']}")
+    
+    def test_upload_idempotency_key(self):
+        """Test that retrying an upload with the same Idempotency-Key does not store it twice"""
+        headers = {"Idempotency-Key": f"test-{time.time()}"}
+        files = {
+            'file': ('idempotent_audio.wav', TEST_WAV_CONTENT, 'audio/wav')
+        }
+        first = requests.post(f"{BASE_URL}/upload", files=files, headers=headers)
+        assert first.status_code == 200
+        
+        retry = requests.post(f"{BASE_URL}/upload", files=files, headers=headers)
+        assert retry.status_code == 200
+        assert retry.json() == first.json()
+        assert retry.headers.get("Idempotent-Replayed") == "true"
+        
+        # The same key with a different file is rejected
+        other_files = {
+            'file': ('other_audio.mp3', TEST_MP3_CONTENT, 'audio/mpeg')
+        }
+        conflict = requests.post(f"{BASE_URL}/upload", files=other_files, headers=headers)
+        assert conflict.status_code == 422
+        
+        # Once the file is deleted, a retry no longer replays it
+        requests.delete(f"{BASE_URL}/files/{first.json()['id']}")
+        after_delete = requests.post(f"{BASE_URL}/upload", files=files, headers=headers)
+        assert after_delete.status_code == 200
+        assert after_delete.json()["id"] != first.json()["id"]
+        assert after_delete.headers.get("Idempotent-Replayed") is None
+        requests.delete(f"{BASE_URL}/files/{after_delete.json()['id']}")
+    
     def test_upload_invalid_file_type(self):
         """Test uploading an invalid file type"""
         # Create a simple text file content
@@ -114,6 +172,52 @@ class TestAPIEndpoints:
             file_ids = [file["id"] for file in data]
             assert TestAPIEndpoints.uploaded_file_id in file_ids
     
+    def test_stats(self):
+        """Test that storage statistics follow uploads and deletes"""
+        response = requests.get(f"{BASE_URL}/stats")
+        assert response.status_code == 200
+        before = response.json()
+        assert before["total_files"] == sum(
+            entry["count"] for entry in before["by_content_type"].values()
+        )
+        assert before["total_bytes"] == sum(
+            entry["bytes"] for entry in before["by_content_type"].values()
+        )
+        
+        files = {
+            'file': ('stats_audio.wav', TEST_WAV_CONTENT, 'audio/wav')
+        }
+        response = requests.post(f"{BASE_URL}/upload", files=files)
+        assert response.status_code == 200
+        file_id = response.json()["id"]
+        
+        after_upload = requests.get(f"{BASE_URL}/stats").json()
+        assert after_upload["total_files"] == before["total_files"] + 1
+        assert after_upload["total_bytes"] == before["total_bytes"] + len(TEST_WAV_CONTENT)
+        assert after_upload["by_content_type"]["audio/wav"]["count"] >= 1
+        
+        requests.delete(f"{BASE_URL}/files/{file_id}")
+        after_delete = requests.get(f"{BASE_URL}/stats").json()
+        assert after_delete["total_files"] == before["total_files"]
+        assert after_delete["total_bytes"] == before["total_bytes"]
+    
+    def test_export_files(self):
+        """Test streaming every file's metadata as NDJSON"""
+        response = requests.get(f"{BASE_URL}/files/export", stream=True)
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("application/x-ndjson")
+        
+        rows = [json.loads(line) for line in response.iter_lines() if line]
+        ids = [row["id"] for row in rows]
+        assert len(ids) == len(set(ids))
+        for row in rows:
+            assert set(row) == {
+                "id", "filename", "content_type", "size", "upload_timestamp", "storage_path"
+            }
+        
+        if TestAPIEndpoints.uploaded_file_id:
+            assert TestAPIEndpoints.uploaded_file_id in ids
+    
     def test_get_file_info(self):
         """Test getting information about a specific file"""
         if not TestAPIEndpoints.uploaded_file_id:
@@ -170,13 +274,34 @@ class TestAPIEndpoints:
         
         # Delete the file
         response = requests.delete(f"{BASE_URL}/files/{TestAPIEndpoints.uploaded_file_id}")
-        assert response.status_code == 200
+        assert response.status_code == 202
         data = response.json()
-        assert data["message"] == "File deleted successfully"
+        assert data["message"] == "File scheduled for deletion"
         
-        # Verify the file is gone
+        # Verify the file is gone, even before the background worker ran
         response = requests.get(f"{BASE_URL}/files/{TestAPIEndpoints.uploaded_file_id}")
         assert response.status_code == 404
+        response = requests.get(f"{BASE_URL}/files/{TestAPIEndpoints.uploaded_file_id}/download")
+        assert response.status_code == 404
+        
+        # Deleting it again is a 404 too
+        response = requests.delete(f"{BASE_URL}/files/{TestAPIEndpoints.uploaded_file_id}")
+        assert response.status_code == 404
+    
+    def test_deletion_status(self):
+        """Test that the deletion queue drains"""
+        response = requests.get(f"{BASE_URL}/deletions/status")
+        assert response.status_code == 200
+        data = response.json()
+        assert data["pending"] >= 0
+        assert data["lag_seconds"] >= 0
+        
+        # The worker is woken by every delete, so the queue should empty quickly
+        for _ in range(20):
+            if requests.get(f"{BASE_URL}/deletions/status").json()["pending"] == 0:
+                break
+            time.sleep(0.5)
+        assert requests.get(f"{BASE_URL}/deletions/status").json()["pending"] == 0
     
     def test_delete_nonexistent_file(self):
         """Test deleting a nonexistent file"""
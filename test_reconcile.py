@@ -0,0 +1,249 @@
+import importlib
+import json
+import sys
+import types
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+# Unit tests for reconcile.py. Unlike test_endpoints.py they need no running
+# server: the bucket and the table are replaced by the in-memory FakeStore
+# below, and config is replaced so no Supabase client is created.
+
+OLD = "2024-01-01T00:00:00.123Z"
+
+
+def file_id(n):
+    return f"{n:02x}{n:02x}0000-0000-4000-8000-{n:012x}"
+
+
+def flat_path(n):
+    return f"{file_id(n)}_track{n}.wav"
+
+
+def sharded_path(n):
+    return f"{file_id(n)[0:2]}/{file_id(n)[2:4]}/{file_id(n)}"
+
+
+class FakeStore:
+    def __init__(self, objects, rows):
+        self.objects = dict(objects)
+        self.rows = sorted(rows, key=lambda row: row["id"])
+        self.fail_at_row = None
+        self.row_calls = []
+        self.list_calls = []
+
+    # Same shape as the storage listing: direct children of `prefix`, sorted
+    # by name, with id None for folders
+    def iter_audio_files(self, prefix="", offset=0, page_size=1000):
+        self.list_calls.append((prefix, offset))
+        base = f"{prefix}/" if prefix else ""
+        entries = {}
+        for path, created_at in self.objects.items():
+            if not path.startswith(base):
+                continue
+            name, slash, _ = path[len(base):].partition("/")
+            entries[name] = {"name": name, "id": None if slash else "object-id", "created_at": created_at}
+        for name in sorted(entries)[offset:]:
+            yield entries[name]
+
+    def iter_metadata_rows(self, columns="*", after=None, page_size=1000, include_deleted=False):
+        self.row_calls.append(after)
+        for row in self.rows:
+            if after is not None and row["id"] <= after:
+                continue
+            if row["id"] == self.fail_at_row:
+                raise Exception("Error listing metadata: connection reset")
+            yield dict(row)
+
+
+@pytest.fixture
+def reconcile(monkeypatch):
+    config = types.ModuleType("config")
+    config.supabase = None
+    config.AUDIO_BUCKET = "audio-files"
+    config.STORAGE_KEY_LAYOUTS = ("flat", "sharded")
+    config.STORAGE_KEY_LAYOUT = "sharded"
+    config.PROFILING_ENABLED = False
+    config.PROFILING_TOKEN = None
+    config.PROFILE_DIR = "profiles"
+    config.PROFILE_MAX_FILES = 100
+    monkeypatch.setitem(sys.modules, "config", config)
+    for name in ("models", "profiling", "storage", "reconcile"):
+        monkeypatch.delitem(sys.modules, name, raising=False)
+
+    yield importlib.import_module("reconcile")
+
+    for name in ("models", "profiling", "storage", "reconcile"):
+        sys.modules.pop(name, None)
+
+
+def use_store(monkeypatch, reconcile, store):
+    monkeypatch.setattr(reconcile, "iter_audio_files", store.iter_audio_files)
+    monkeypatch.setattr(reconcile, "iter_metadata_rows", store.iter_metadata_rows)
+
+
+def make_reconciler(reconcile, tmp_path, page_size=1000):
+    return reconcile.Reconciler(
+        report_path=str(tmp_path / "report.jsonl"),
+        checkpoint_path=str(tmp_path / "checkpoint.json"),
+        page_size=page_size,
+        batch_size=100,
+        min_age=timedelta(minutes=60),
+        delete=False
+    )
+
+
+def read_report(tmp_path):
+    with open(tmp_path / "report.jsonl") as f:
+        return [json.loads(line) for line in f]
+
+
+# A bucket half way through a migration from the flat to the sharded layout
+def mixed_store():
+    recent = datetime.now(timezone.utc).isoformat()
+    objects = {
+        flat_path(1): OLD,        # matched by its row
+        sharded_path(2): OLD,     # matched by its row
+        flat_path(3): OLD,        # orphan
+        sharded_path(4): OLD,     # orphan
+        flat_path(6): OLD,        # left behind by the migration
+        sharded_path(6): OLD,     # matched by its row
+        sharded_path(7): recent,  # orphan, but too new to report
+        flat_path(8): OLD,        # matched by its row
+        "readme.txt": OLD,        # not written by the API
+    }
+    rows = [
+        {"id": file_id(1), "storage_path": flat_path(1), "upload_timestamp": OLD},
+        {"id": file_id(2), "storage_path": sharded_path(2), "upload_timestamp": OLD},
+        {"id": file_id(5), "storage_path": flat_path(5), "upload_timestamp": OLD},
+        {"id": file_id(6), "storage_path": sharded_path(6), "upload_timestamp": OLD},
+        {"id": file_id(8), "storage_path": flat_path(8), "upload_timestamp": OLD},
+    ]
+    return FakeStore(objects, rows)
+
+
+EXPECTED_ORPHANS = [
+    {"kind": "object", "id": file_id(3), "path": flat_path(3)},
+    {"kind": "object", "id": file_id(4), "path": sharded_path(4)},
+    {"kind": "row", "id": file_id(5), "path": flat_path(5)},
+    {"kind": "object", "id": file_id(6), "path": flat_path(6)},
+]
+
+
+class TestParseTimestamp:
+    def test_storage_timestamp(self, reconcile):
+        """Storage returns milliseconds and a Z suffix"""
+        parsed = reconcile._parse_timestamp("2024-01-02T03:04:05.123Z")
+        assert parsed == datetime(2024, 1, 2, 3, 4, 5, 123000, tzinfo=timezone.utc)
+
+    def test_postgrest_timestamp(self, reconcile):
+        """PostgREST trims trailing zeros from the fraction and uses a numeric offset"""
+        parsed = reconcile._parse_timestamp("2024-01-02T03:04:05.12345+02:00")
+        assert parsed == datetime(2024, 1, 2, 1, 4, 5, 123450, tzinfo=timezone.utc)
+
+    def test_naive_timestamp_is_utc(self, reconcile):
+        """A timestamp without a zone is taken to be UTC"""
+        parsed = reconcile._parse_timestamp("2024-01-02 03:04:05")
+        assert parsed == datetime(2024, 1, 2, 3, 4, 5, tzinfo=timezone.utc)
+
+    def test_invalid_timestamp(self, reconcile):
+        """Missing or malformed timestamps parse to None"""
+        assert reconcile._parse_timestamp(None) is None
+        assert reconcile._parse_timestamp("") is None
+        assert reconcile._parse_timestamp("yesterday") is None
+
+
+class TestReconcileScan:
+    def test_merges_both_layouts(self, reconcile, monkeypatch, tmp_path):
+        """Flat and sharded objects are matched against the rows in one pass"""
+        store = mixed_store()
+        use_store(monkeypatch, reconcile, store)
+
+        reconciler = make_reconciler(reconcile, tmp_path)
+        reconciler.run()
+
+        report = read_report(tmp_path)
+        assert [entry for entry in report if entry["kind"] != "unknown"] == EXPECTED_ORPHANS
+        assert [entry for entry in report if entry["kind"] == "unknown"] == [
+            {"kind": "unknown", "path": "readme.txt"}
+        ]
+        assert reconciler.counts["objects"] == 9
+        assert reconciler.counts["rows"] == 5
+        assert reconciler.counts["orphan_objects"] == 3
+        assert reconciler.counts["orphan_rows"] == 1
+        assert reconciler.counts["unknown_objects"] == 1
+        assert reconciler.counts["skipped_recent"] == 1
+        assert reconciler.state["scan_complete"]
+
+    def test_unsorted_listing_aborts(self, reconcile, monkeypatch, tmp_path):
+        """The scan refuses to go on if the table is not in id order"""
+        store = mixed_store()
+        store.rows.reverse()
+        use_store(monkeypatch, reconcile, store)
+
+        with pytest.raises(RuntimeError, match="not sorted"):
+            make_reconciler(reconcile, tmp_path).run()
+
+    def test_resume_after_interrupted_scan(self, reconcile, monkeypatch, tmp_path):
+        """A second run continues from the checkpoint and reports each orphan once"""
+        store = mixed_store()
+        store.fail_at_row = file_id(6)
+        use_store(monkeypatch, reconcile, store)
+
+        with pytest.raises(Exception, match="connection reset"):
+            make_reconciler(reconcile, tmp_path, page_size=2).run()
+
+        with open(tmp_path / "checkpoint.json") as f:
+            checkpoint = json.load(f)
+        assert checkpoint["last_id"] == file_id(4)
+        assert not checkpoint["scan_complete"]
+
+        store.fail_at_row = None
+        store.row_calls.clear()
+        store.list_calls.clear()
+        reconciler = make_reconciler(reconcile, tmp_path, page_size=2)
+        reconciler.run()
+
+        # Picked up after the last checkpointed id instead of starting over
+        assert store.row_calls == [file_id(4)]
+        assert ("", checkpoint["root_offset"]) in store.list_calls
+        assert ("00", 0) not in store.list_calls
+
+        report = read_report(tmp_path)
+        assert [entry for entry in report if entry["kind"] != "unknown"] == EXPECTED_ORPHANS
+        assert [entry for entry in report if entry["kind"] == "unknown"] == [
+            {"kind": "unknown", "path": "readme.txt"}
+        ]
+        assert reconciler.state["scan_complete"]
+
+    def test_resume_does_not_repeat_unknown_objects(self, reconcile, monkeypatch, tmp_path):
+        """Unknown objects reported before the checkpoint are not reported again"""
+        store = mixed_store()
+        store.objects["0b/0b/notes.txt"] = OLD
+        for n in (9, 10, 11, 12):
+            store.objects[sharded_path(n)] = OLD
+            store.rows.append({"id": file_id(n), "storage_path": sharded_path(n), "upload_timestamp": OLD})
+        store.fail_at_row = file_id(12)
+        use_store(monkeypatch, reconcile, store)
+
+        with pytest.raises(Exception, match="connection reset"):
+            make_reconciler(reconcile, tmp_path, page_size=2).run()
+
+        store.fail_at_row = None
+        make_reconciler(reconcile, tmp_path, page_size=2).run()
+
+        unknown = [entry["path"] for entry in read_report(tmp_path) if entry["kind"] == "unknown"]
+        assert sorted(unknown) == ["0b/0b/notes.txt", "readme.txt"]
+
+    def test_completed_scan_is_not_repeated(self, reconcile, monkeypatch, tmp_path):
+        """Once the scan is complete, a resumed run goes straight to removal"""
+        store = mixed_store()
+        use_store(monkeypatch, reconcile, store)
+        make_reconciler(reconcile, tmp_path).run()
+
+        store.row_calls.clear()
+        make_reconciler(reconcile, tmp_path).run()
+
+        assert store.row_calls == []
+        assert len(read_report(tmp_path)) == len(EXPECTED_ORPHANS) + 1